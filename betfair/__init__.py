@@ -2,12 +2,154 @@
 
 from __future__ import annotations
 
-import tempfile
+import atexit
+import hashlib
+import logging
+import operator
 import os
-from datetime import datetime, timedelta
-from typing import Any, Dict, Generator, List, Sequence
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+)
 
 import betfairlightweight
+from betfairlightweight.exceptions import BetfairError
+
+# Maximum number of API requests in flight at the same time.
+MAX_CONCURRENCY = 64
+
+# Default number of days ahead to look for markets.
+MAX_DAYS_LEFT = 7
+
+# Time format expected by Betfair filters.
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# Catalogue data needed to describe markets.
+MARKET_PROJECTION = ("COMPETITION", "MARKET_DESCRIPTION", "RUNNER_DESCRIPTION", "EVENT")
+
+# Maximum number of market ids Betfair accepts on a single market book request.
+MAX_BOOKS_PER_REQUEST = 40
+
+
+def _gather(func: Callable, calls: Sequence[Dict[str, Any]]) -> List[Any]:
+    """Run blocking calls concurrently in threads, keeping the calls order."""
+    if not calls:
+        return []
+    with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENCY, len(calls))) as executor:
+        return list(executor.map(lambda kwargs: func(**kwargs), calls))
+
+
+class OpenBet(NamedTuple):
+    """Current open bet."""
+
+    average_price_matched: float
+    bet_id: str
+    bsp_liability: float
+    customer_order_ref: Optional[str]
+    customer_strategy_ref: Optional[str]
+    handicap: float
+    market_id: str
+    matched_date: Optional[str]
+    order_type: str
+    persistence_type: str
+    placed_date: str
+    price: float
+    size: float
+    regulator_auth_code: Optional[str]
+    regulator_code: Optional[str]
+    selection_id: int
+    side: str
+    size_cancelled: float
+    size_lapsed: float
+    size_matched: float
+    size_remaining: float
+    size_voided: float
+    status: str
+    current_item_description: Any
+
+
+class SettledBet(NamedTuple):
+    """Cleared bet."""
+
+    bet_count: int
+    bet_id: str
+    bet_outcome: str
+    customer_order_ref: Optional[str]
+    customer_strategy_ref: Optional[str]
+    event_id: str
+    event_type_id: str
+    handicap: float
+    last_matched_date: Optional[str]
+    market_id: str
+    order_type: str
+    persistence_type: str
+    placed_date: str
+    price_matched: float
+    price_reduced: bool
+    price_requested: float
+    profit: float
+    commission: float
+    selection_id: int
+    settled_date: str
+    side: str
+    size_settled: float
+    size_cancelled: float
+    item_description: Any
+
+
+class Offer(NamedTuple):
+    """Best available price to back or lay a runner."""
+
+    event_name: str
+    market_id: str
+    market_time: datetime
+    competition_id: int
+    competition_name: str
+    market_rate: float
+    selection_id: int
+    option: str
+    price: float
+    size: float
+
+
+# Order attributes read for each open bet field.
+OPEN_BET_ATTRS = [
+    {"price": "price_size.price", "size": "price_size.size"}.get(field, field)
+    for field in OpenBet._fields
+]
+
+
+def _records(
+    objs: Sequence[Any],
+    record: Type[NamedTuple],
+    attrs: Sequence[str],
+    dates: Sequence[str],
+) -> List[NamedTuple]:
+    """Flatten objects attributes into records, with dates in ISO format."""
+    getter = operator.attrgetter(*attrs)
+    positions = [record._fields.index(col) for col in dates]
+    records = []
+    for obj in objs:
+        values = list(getter(obj))
+        for i in positions:
+            # Dates may be missing, e.g. the matched date of unmatched orders.
+            if values[i] is not None:
+                values[i] = values[i].isoformat()
+        records.append(record._make(values))
+    return records
 
 
 class Betfair:
@@ -22,70 +164,23 @@ class Betfair:
         )
         self.trading.login()
 
-    def open_bets(self) -> List[str]:
+    def open_bets(self) -> List[OpenBet]:
         """Get current open bets."""
-        return [
-            {
-                "average_price_matched": o.average_price_matched,
-                "bet_id": o.bet_id,
-                "bsp_liability": o.bsp_liability,
-                "customer_order_ref": o.customer_order_ref,
-                "customer_strategy_ref": o.customer_strategy_ref,
-                "handicap": o.handicap,
-                "market_id": o.market_id,
-                "matched_date": o.matched_date.isoformat(),
-                "order_type": o.order_type,
-                "persistence_type": o.persistence_type,
-                "placed_date": o.placed_date.isoformat(),
-                "price": o.price_size.price,
-                "size": o.price_size.size,
-                "regulator_auth_code": o.regulator_auth_code,
-                "regulator_code": o.regulator_code,
-                "selection_id": o.selection_id,
-                "side": o.side,
-                "size_cancelled": o.size_cancelled,
-                "size_lapsed": o.size_lapsed,
-                "size_matched": o.size_matched,
-                "size_remaining": o.size_remaining,
-                "size_voided": o.size_voided,
-                "status": o.status,
-                "current_item_description": o.current_item_description,
-            }
-            for o in self.trading.betting.list_current_orders().orders
-        ]
+        return _records(
+            self.trading.betting.list_current_orders().orders,
+            record=OpenBet,
+            attrs=OPEN_BET_ATTRS,
+            dates=["matched_date", "placed_date"],
+        )
 
-    def settled_bets(self) -> List[str]:
+    def settled_bets(self) -> List[SettledBet]:
         """Get settled bets."""
-
-        return [
-            {
-                "bet_count": o.bet_count,
-                "bet_id": o.bet_id,
-                "bet_outcome": o.bet_outcome,
-                "customer_order_ref": o.customer_order_ref,
-                "customer_strategy_ref": o.customer_strategy_ref,
-                "event_id": o.event_id,
-                "event_type_id": o.event_type_id,
-                "handicap": o.handicap,
-                "last_matched_date": o.last_matched_date.isoformat(),
-                "market_id": o.market_id,
-                "order_type": o.order_type,
-                "persistence_type": o.persistence_type,
-                "placed_date": o.placed_date.isoformat(),
-                "price_matched": o.price_matched,
-                "price_reduced": o.price_reduced,
-                "price_requested": o.price_requested,
-                "profit": o.profit,
-                "commission": o.commission,
-                "selection_id": o.selection_id,
-                "settled_date": o.settled_date.isoformat(),
-                "side": o.side,
-                "size_settled": o.size_settled,
-                "size_cancelled": o.size_cancelled,
-                "item_description": o.item_description,
-            }
-            for o in self.trading.betting.list_cleared_orders().orders
-        ]
+        return _records(
+            self.trading.betting.list_cleared_orders().orders,
+            record=SettledBet,
+            attrs=SettledBet._fields,
+            dates=["last_matched_date", "placed_date", "settled_date"],
+        )
 
     def place_bet(
         self,
@@ -128,39 +223,92 @@ class Betfair:
         """Get current available."""
         return self.trading.account.get_account_funds().available_to_bet_balance
 
+    def _market_catalogues(
+        self,
+        competition_id: int,
+        page_size: int,
+        market_start_time: Optional[Dict[str, str]] = None,
+        market_projection: Sequence[str] = MARKET_PROJECTION,
+    ) -> List[Any]:
+        """Get match odds catalogues from a competition, paging past max results."""
+        catalogues = {}
+        market_start_time = dict(market_start_time or {})
+        while True:
+            page = self.trading.betting.list_market_catalogue(
+                market_projection=list(market_projection),
+                filter=betfairlightweight.filters.market_filter(
+                    market_type_codes=["MATCH_ODDS"],
+                    competition_ids=[competition_id],
+                    market_start_time=market_start_time or None,
+                ),
+                sort="FIRST_TO_START",
+                max_results=page_size,
+            )
+            new = {
+                mkt.market_id: mkt for mkt in page if mkt.market_id not in catalogues
+            }
+            catalogues.update(new)
+
+            # A full page means Betfair may have truncated the results, so continue
+            # from the latest market start time.
+            if len(page) < page_size:
+                return list(catalogues.values())
+            if not new:
+                # Paging by start time cannot get past a page of markets that
+                # all start at the same time.
+                logging.warning(
+                    "Competition %s: more than %s markets start at %s, "
+                    "some were not retrieved",
+                    competition_id,
+                    page_size,
+                    market_start_time["from"],
+                )
+                return list(catalogues.values())
+            start = max(mkt.market_start_time for mkt in page)
+            market_start_time["from"] = start.strftime(TIME_FORMAT)
+
+    def market_catalogues(
+        self,
+        competition_ids: Sequence[int],
+        page_size: int = 1000,
+        market_start_time: Optional[Dict[str, str]] = None,
+        market_projection: Sequence[str] = MARKET_PROJECTION,
+    ) -> List[List[Any]]:
+        """Get match odds catalogues of each competition, requested concurrently.
+
+        Each competition is paged `page_size` markets at a time, past the Betfair
+        results limit.
+        """
+        calls = [
+            {
+                "competition_id": competition_id,
+                "page_size": page_size,
+                "market_start_time": market_start_time,
+                "market_projection": market_projection,
+            }
+            for competition_id in competition_ids
+        ]
+        return _gather(self._market_catalogues, calls)
+
     def markets(
         self,
         competition_ids: Sequence[int],
-        max_results: int = 1000,
-        max_days_left: int = 7,
+        page_size: int = 1000,
+        max_days_left: int = MAX_DAYS_LEFT,
     ) -> Generator[Dict[str, Any]]:
-        """Get open markets from specified competitions."""
-        for competition_id in competition_ids:
-            # Filter match odds only for the competitions I am interested in.
-            market_filter = betfairlightweight.filters.market_filter(
-                market_type_codes=["MATCH_ODDS"],
-                competition_ids=[competition_id],
-            )
+        """Get open markets from specified competitions, up to `max_days_left`."""
+        # Let Betfair drop markets beyond the date limit.
+        lim = datetime.now(timezone.utc) + timedelta(days=max_days_left)
 
-            # Get market data.
-            market_catalogues = self.trading.betting.list_market_catalogue(
-                market_projection=[
-                    "COMPETITION",
-                    "MARKET_DESCRIPTION",
-                    "RUNNER_DESCRIPTION",
-                    "EVENT",
-                ],
-                filter=market_filter,
-                max_results=max_results,
-            )
+        results = self.market_catalogues(
+            competition_ids,
+            page_size=page_size,
+            market_start_time={"to": lim.strftime(TIME_FORMAT)},
+        )
 
+        for market_catalogues in results:
             # Flatten market data.
             for mkt in market_catalogues:
-                # Check date limit.
-                lim = datetime.now() + timedelta(days=max_days_left)
-                if mkt.description.market_time > lim:
-                    continue
-
                 yield {
                     "event_name": mkt.event.name,
                     "market_id": mkt.market_id,
@@ -177,62 +325,89 @@ class Betfair:
     def books(
         self,
         competition_ids: Sequence[int],
-        max_markets: int = 1000,
-    ) -> Generator[Dict[str, Any]]:
-        """Get books for an specific market."""
-        for market in self.markets(competition_ids, max_markets):
-            # Get the books for each market id.
-            market_book = self.trading.betting.list_market_book(
-                market_ids=[market["market_id"]],
-                price_projection={"priceData": ["EX_BEST_OFFERS"]},
-            )[0]
+        page_size: int = 1000,
+    ) -> Generator[List[Offer]]:
+        """Get books for an specific market.
+
+        `page_size` is the number of markets per catalogue request.
+        """
+        markets = list(self.markets(competition_ids, page_size))
+
+        # Get the books in batches of market ids, requesting batches concurrently.
+        batches = [
+            markets[i : i + MAX_BOOKS_PER_REQUEST]
+            for i in range(0, len(markets), MAX_BOOKS_PER_REQUEST)
+        ]
+        calls = [
+            {
+                "market_ids": [market["market_id"] for market in batch],
+                "price_projection": {"priceData": ["EX_BEST_OFFERS"]},
+            }
+            for batch in batches
+        ]
+        results = _gather(self.trading.betting.list_market_book, calls)
+
+        # Books are not guaranteed to come in the requested order.
+        market_books = {
+            market_book.market_id: market_book
+            for market_books in results
+            for market_book in market_books
+        }
+
+        for market in markets:
+            market_book = market_books.get(market["market_id"])
+            if market_book is None:
+                continue
 
             # Check if market is open and avoid inplay.
             if market_book.status != "OPEN" or market_book.inplay:
                 continue
 
-            # Flatten back and lay separately.
-            back = [
-                {
-                    "event_name": market["event_name"],
-                    "market_id": market["market_id"],
-                    "market_time": market["market_time"],
-                    "competition_id": market["competition_id"],
-                    "competition_name": market["competition_name"],
-                    "selection_id": r.selection_id,
-                    "option": "back",
-                    "price": r.ex.available_to_back[0].price,
-                    "size": r.ex.available_to_back[0].size,
-                    "market_rate": market["market_base_rate"],
-                }
-                for r in market_book.runners
-                if r.ex.available_to_lay
-            ]
-            lay = [
-                {
-                    "event_name": market["event_name"],
-                    "market_id": market["market_id"],
-                    "market_time": market["market_time"],
-                    "competition_id": market["competition_id"],
-                    "competition_name": market["competition_name"],
-                    "selection_id": r.selection_id,
-                    "option": "lay",
-                    "price": r.ex.available_to_lay[0].price,
-                    "size": r.ex.available_to_lay[0].size,
-                    "market_rate": market["market_base_rate"],
-                }
-                for r in market_book.runners
-                if r.ex.available_to_lay
-            ]
-            if len(back + lay) > 0:
-                yield back + lay
+            # Market fields shared by every row.
+            base = {
+                "event_name": market["event_name"],
+                "market_id": market["market_id"],
+                "market_time": market["market_time"],
+                "competition_id": market["competition_id"],
+                "competition_name": market["competition_name"],
+                "market_rate": market["market_base_rate"],
+            }
 
+            # Flatten back and lay of each runner in a single pass.
+            rows = []
+            for r in market_book.runners:
+                for option, available in [
+                    ("back", r.ex.available_to_back),
+                    ("lay", r.ex.available_to_lay),
+                ]:
+                    if not available:
+                        continue
+                    rows.append(
+                        Offer(
+                            **base,
+                            selection_id=r.selection_id,
+                            option=option,
+                            price=available[0].price,
+                            size=available[0].size,
+                        )
+                    )
+            if rows:
+                yield rows
 
-def login(username: str, password: str, app_key: str, certificate: str, key: str) -> Betfair:
-    """Login on betfair API"""
 
-    # Create a temp certificates folder to avoid data leakage.
-    with tempfile.TemporaryDirectory() as tmp:
+# Certificates folders already written, by the hash of their content.
+_CERTS: Dict[str, str] = {}
+
+
+def certificates(certificate: str, key: str) -> str:
+    """Write certificates to a temp folder, once per process, and get its path."""
+    digest = hashlib.blake2b((certificate + key).encode(), digest_size=16).hexdigest()
+    if digest not in _CERTS:
+        # Keep the folder for the whole process, because the client may read the
+        # certificates again when refreshing the session.
+        tmp = tempfile.mkdtemp()
+        atexit.register(shutil.rmtree, tmp, ignore_errors=True)
+
         cert_path = os.path.join(tmp, "client-2040.crt")
         with open(cert_path, mode="w", encoding="utf-8") as file:
             file.write(certificate)
@@ -241,9 +416,36 @@ def login(username: str, password: str, app_key: str, certificate: str, key: str
         with open(key_path, mode="w", encoding="utf-8") as file:
             file.write(key)
 
-        return Betfair(
-            username=username,
-            password=password,
-            app_key=app_key,
-            certs=tmp,
-        )
+        _CERTS[digest] = tmp
+    return _CERTS[digest]
+
+
+# Clients shared by every login in the process, by username and app key.
+_CLIENTS: Dict[Tuple[str, str], Betfair] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def login(username: str, password: str, app_key: str, certificate: str, key: str) -> Betfair:
+    """Login on betfair API, once per username and app key.
+
+    Later calls return the same client, so the password and certificates from the
+    first call are the ones used. An expired session is refreshed on the next
+    login() call, not while the returned client is held.
+    """
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get((username, app_key))
+        if client is None:
+            client = Betfair(
+                username=username,
+                password=password,
+                app_key=app_key,
+                certs=certificates(certificate=certificate, key=key),
+            )
+            _CLIENTS[(username, app_key)] = client
+        elif client.trading.session_expired:
+            # Keep alive fails once the session has actually timed out.
+            try:
+                client.trading.keep_alive()
+            except BetfairError:
+                client.trading.login()
+        return client
@@ -1,15 +1,13 @@
 """Bot for automated value betting on BetFair."""
 
-import tempfile
 import logging
 import os
 
+import orjson
 import pandas as pd
 
 import betfair
 from betfair import betting
-import betfairlightweight
-from betfairlightweight import filters
 
 # Competitions
 COMPS = ["10932509"]  # English Premier League
@@ -20,6 +18,28 @@ MIN_BET = 5.0
 MIN_LIABILITY = MIN_BET * 5
 MIN_EV = 0.0
 FRACTION = 0.25
+MAX_WORKERS = 8  # Bets placed at the same time.
+
+# Known types of the books rows, to avoid inferring them for every market.
+BOOK_DTYPES = {
+    "event_name": "string",
+    "market_id": "string",
+    "competition_id": "Int64",
+    "competition_name": "string",
+    "selection_id": "Int64",
+    "option": "string",
+    "price": "float64",
+    "size": "float64",
+    "market_rate": "float64",
+}
+
+# Known types of the runners selection ids.
+SELECTION_DTYPES = {
+    "competition_id": "Int64",
+    "competition_name": "string",
+    "selection_id": "Int64",
+    "runner_name": "string",
+}
 
 # Auth
 USERNAME = os.getenv("BETFAIR_USERNAME")
@@ -33,38 +53,43 @@ logging.getLogger().setLevel(logging.INFO)
 pd.options.mode.chained_assignment = None
 
 
-def login(
-    username: str,
-    password: str,
-    app_key: str,
-    certificate: str,
-    key: str,
-) -> betfairlightweight.APIClient:
-    """Login on betfair API"""
-
-    # Create a temp certificates folder to avoid data leakage.
-    with tempfile.TemporaryDirectory() as tmp:
-        cert_path = os.path.join(tmp, "client-2040.crt")
-        with open(cert_path, mode="w", encoding="utf-8") as file:
-            file.write(certificate)
-
-        key_path = os.path.join(tmp, "client-2040.key")
-        with open(key_path, mode="w", encoding="utf-8") as file:
-            file.write(key)
-
-        client = betfairlightweight.APIClient(
-            username=username,
-            password=password,
-            app_key=app_key,
-            certs=tmp,
-        )
-        client.login()
-        return client
-
-
 def load_proba():
     """Load probabilities."""
-    df = pd.read_json("soccer_epl.json")
+    with open("soccer_epl.json", mode="rb") as file:
+        events = orjson.loads(file.read())
+
+    # Flatten events, bookmakers, markets and outcomes in a single pass.
+    df = pd.DataFrame(
+        [
+            {
+                "id": event["id"],
+                "sport_key": event["sport_key"],
+                "sport_title": event["sport_title"],
+                "commence_time": event["commence_time"],
+                "home_team": event["home_team"],
+                "away_team": event["away_team"],
+                "bookmakers.key": bookmaker["key"],
+                "bookmakers.title": bookmaker["title"],
+                "bookmakers.last_update": bookmaker["last_update"],
+                "bookmakers.markets.key": market["key"],
+                "bookmakers.markets.last_update": market["last_update"],
+                "bookmakers.markets.outcomes.name": outcome["name"],
+                "bookmakers.markets.outcomes.price": outcome["price"],
+            }
+            for event in events
+            for bookmaker in event["bookmakers"]
+            for market in bookmaker["markets"]
+            for outcome in market["outcomes"]
+        ]
+    )
+    for col in [
+        "commence_time",
+        "bookmakers.last_update",
+        "bookmakers.markets.last_update",
+    ]:
+        df[col] = pd.to_datetime(df[col])
+    df = df.convert_dtypes()
+
     df_lookup = pd.read_json(
         "theoddsapi2betfair.json",
         # dtype={
@@ -75,15 +100,6 @@ def load_proba():
         # },
     )
 
-    keys = []
-    for key in ["bookmakers", "markets", "outcomes"]:
-        keys.append(key)
-        col = ".".join(keys)
-        df = pd.json_normalize(df.explode(col).to_dict(orient="records"))
-        if f"{col}.last_update" in df.columns:
-            df[f"{col}.last_update"] = pd.to_datetime(df[f"{col}.last_update"])
-            df = df.convert_dtypes()
-
     return df.merge(
         df_lookup,
         left_on=["sport_key", "bookmakers.markets.outcomes.name"],
@@ -94,7 +110,7 @@ def load_proba():
 
 
 def unmatched():
-    client = login(
+    trading = betfair.login(
         username=USERNAME,
         password=PASSWORD,
         app_key=APP_KEY,
@@ -102,33 +118,27 @@ def unmatched():
         key=KEY,
     )
 
-    # Get selection_id from all runners
-    # Do it one competition at time to avoid hitting max results limits.
-
+    # Get selection_id from all runners, requesting competitions concurrently.
     df_selection = (
-        pd.DataFrame.from_records(
+        pd.DataFrame(
             [
-                {
-                    "competition_id": int(market.competition.id),
-                    "competition_name": market.competition.name,
-                    "selection_id": runner.selection_id,
-                    "runner_name": runner.runner_name,
-                }
-                for comp in COMPS
-                for market in client.betting.list_market_catalogue(
+                (
+                    int(market.competition.id),
+                    market.competition.name,
+                    runner.selection_id,
+                    runner.runner_name,
+                )
+                for markets in trading.market_catalogues(
+                    COMPS,
                     market_projection=["COMPETITION", "RUNNER_DESCRIPTION"],
-                    filter=filters.market_filter(
-                        market_type_codes=["MATCH_ODDS"],
-                        competition_ids=[comp],
-                    ),
-                    max_results=1000,
                 )
+                for market in markets
                 for runner in market.runners
-            ]
+            ],
+            columns=list(SELECTION_DTYPES),
         )
-        .convert_dtypes()
-        .groupby(["competition_name", "runner_name"], as_index=False)
-        .last()
+        .astype(SELECTION_DTYPES)
+        .drop_duplicates(["competition_name", "runner_name"], keep="last")
     )
 
     df_proba = load_proba()
@@ -147,6 +157,16 @@ def unmatched():
     )
 
 
+# Only needed by main.
+# from concurrent.futures import ThreadPoolExecutor
+
+# import boto3
+# import numpy as np
+# from betfairlightweight.exceptions import BetfairError
+
+# BUCKET_NAME = os.getenv("BUCKET_NAME")
+
+
 # def main(*args, **kwargs):  # pylint: disable=unused-argument
 #     """Main execution."""
 #     # Login on Betfair API.
@@ -159,31 +179,38 @@ def unmatched():
 #     )
 
 #     # Check and store markets that had already received a bet.
-#     already_bet = [o["market_id"] for o in trading.open_bets()]
+#     # Fetch it only once here, never inside the markets loop.
+#     already_bet = {o.market_id for o in trading.open_bets()}
 #     logging.info("There are %s open bets", len(already_bet))
 
+#     # Get my bankroll once, so all markets share a single account request.
+#     bankroll = trading.bankroll()
+
 #     df_proba = load_proba()
 
+#     # Create the storage client once, it is costly to build.
+#     s3 = boto3.client("s3")
+
 #     bets = []
-#     # for book in trading.books(df_proba["competition_id"].unique().astype(int).tolist()):
-#     for book in trading.markets(competition_ids=[10932509]):
+#     competition_ids = df_proba["betfair_competition_id"].unique().astype(int).tolist()
+#     for book in trading.books(competition_ids=competition_ids):
 
 #         # Load data into a DataFrame.
 #         df_book = (
-#             pd.DataFrame().from_records(book).convert_dtypes().query("option == 'back'")
+#             pd.DataFrame.from_records(book, columns=betfair.Offer._fields)
+#             .astype(BOOK_DTYPES)
+#             .query("option == 'back'")
 #         )
 #         pass
 
+#         # All rows share the same market time, so convert it only once.
+#         market_time = pd.Timestamp(book[0].market_time, tz="UTC")
+
 #         # Extract date for Pacific Time to match FiveThirtyEight timezone.
-#         df_book["market_time"] = pd.to_datetime(df_book["market_time"], utc=True)
-#         df_book["date"] = (
-#             df_book["market_time"]
-#             .dt.tz_convert("America/Los_Angeles")
-#             .dt.date.astype(pd.StringDtype())
-#         )
+#         df_book["date"] = str(market_time.tz_convert("America/Los_Angeles").date())
 
 #         # Make sure data is in a serializable format
-#         df_book["market_time"] = df_book["market_time"].apply(lambda x: x.isoformat())
+#         df_book["market_time"] = market_time.isoformat()
 
 #         # Merge Betfair and FiveThirtyEight data.
 #         merge_on = ["event_name", "date", "competition_id", "selection_id"]
@@ -199,42 +226,33 @@ def unmatched():
 #             continue
 
 #         # Invert probability for laying calculation.
-#         df_bets["proba"] = df_bets.apply(
-#             lambda x: x["proba"] if x["option"] == "back" else 1 - x["proba"],
-#             axis=1,
-#         )
+#         is_back = df_bets["option"].eq("back").to_numpy()
+#         df_bets["proba"] = np.where(is_back, df_bets["proba"], 1 - df_bets["proba"])
 
 #         # Calculate percentage from the bankroll to bet.
-#         df_bets["kelly"] = df_bets.apply(
-#             lambda x: betting.kelly_criterion(
-#                 proba=x["proba"],
-#                 odds=x["price"],
-#                 fraction=FRACTION,
-#             ),
-#             axis=1,
+#         df_bets["kelly"] = betting.kelly_criterion(
+#             proba=df_bets["proba"].to_numpy(),
+#             odds=df_bets["price"].to_numpy(),
+#             fraction=FRACTION,
 #         )
 
-#         # Get my bankroll and estimate how much to bet (liability).
-#         df_bets["liability"] = df_bets["kelly"].clip(0) * trading.bankroll()
+#         # Estimate how much to bet (liability).
+#         df_bets["liability"] = df_bets["kelly"].clip(0) * bankroll
 
 #         # Converts liability to stake.
-#         df_bets["stake"] = df_bets.apply(
-#             lambda x: x["liability"]
-#             if x["option"] == "back"
-#             else x["liability"] / (x["price"] - 1),
-#             axis=1,
+#         df_bets["stake"] = np.where(
+#             is_back,
+#             df_bets["liability"],
+#             df_bets["liability"] / (df_bets["price"] - 1),
 #         ).round(2)
 
 #         # Estimate the expected value for each possible bet on this market.
-#         df_bets["ev"] = df_bets.apply(
-#             lambda x: betting.expected_value(
-#                 stake=x["stake"],
-#                 proba=x["proba"],
-#                 odds=x["price"],
-#                 rate=x["market_rate"],
-#                 option=x["option"],
-#             ),
-#             axis=1,
+#         df_bets["ev"] = betting.expected_value(
+#             stake=df_bets["stake"].to_numpy(),
+#             proba=df_bets["proba"].to_numpy(),
+#             odds=df_bets["price"].to_numpy(),
+#             rate=df_bets["market_rate"].to_numpy(),
+#             option=df_bets["option"].to_numpy(),
 #         )
 
 #         # Skip if it is an already bet market.
@@ -277,14 +295,36 @@ def unmatched():
 #             bet["price"],
 #         )
 
-#         # Place bet
-#         report = trading.place_bet(
-#             market_id=bet["market_id"],
-#             selection_id=bet["selection_id"],
-#             stake=bet["stake"],
-#             price=bet["price"],
-#             option=bet["option"],
-#         )
+#         # Place it later, together with bets from other markets.
+#         bets.append(bet)
+
+#     # Place all bets concurrently, since each one is a blocking request.
+#     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+#         futures = [
+#             executor.submit(
+#                 trading.place_bet,
+#                 market_id=bet["market_id"],
+#                 selection_id=bet["selection_id"],
+#                 stake=bet["stake"],
+#                 price=bet["price"],
+#                 option=bet["option"],
+#             )
+#             for bet in bets
+#         ]
+
+#     placed = []
+#     for bet, future in zip(bets, futures):
+#         # A failed bet must not prevent recording the ones already placed.
+#         try:
+#             report = future.result()
+#         except (ValueError, BetfairError) as err:
+#             logging.error(
+#                 "%s - %s: Bet failed (%s)",
+#                 bet["competition_name"],
+#                 bet["event_name"],
+#                 err,
+#             )
+#             continue
 
 #         # Include data from the bet
 #         bet["placed_at"] = report["placed_date"]
@@ -292,14 +332,22 @@ def unmatched():
 #         bet["status"] = report["status"].lower()
 
 #         # Store bet as a dict to be returned at the end.
-#         boto3.client("s3").put_object(
+#         # Missing values are stored as null, as pandas to_json did.
+#         bet = bet.astype(object).where(bet.notna(), None).to_dict()
+#         s3.put_object(
 #             Bucket=BUCKET_NAME,
 #             Key=f"bets/{bet['bet_id']}.json",
-#             Body=bet.to_json(),
+#             Body=orjson.dumps(
+#                 bet,
+#                 option=orjson.OPT_SERIALIZE_NUMPY,
+#                 default=lambda x: (
+#                     x.isoformat() if isinstance(x, pd.Timestamp) else str(x)
+#                 ),
+#             ),
 #         )
-#         bets.append(bet.to_dict())
+#         placed.append(bet)
 
-#     return bets
+#     return placed
 
 
 if __name__ == "__main__":